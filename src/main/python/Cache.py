@@ -1,4 +1,5 @@
 import glob
+import os
 import pickle
 from abc import ABC, abstractmethod
 from pathlib import Path
@@ -15,33 +16,57 @@ T = TypeVar("T")
 
 
 # TODO: Keep track of `state`s in an index file, to prevent overly long filenames
-# TODO: Add some kind of versioning, in case code makes a breaking change w.r.t. users' existing caches
 class Cache(ABC, Generic[T]):
     """
     Stores data identified by a key, associated with a state that identifies the contents of the datum.
 
     Only a single datum can be stored under any given key. If a datum is stored under a used key, the existing datum and
     its state are overwritten.
+
+    Cached files additionally record a version. When the code that produces a datum changes in a way that invalidates
+    existing caches, the corresponding stage bumps its version, and all data stored under older versions is evicted the
+    next time the cache is constructed. This way, users do not have to clear their entire cache after an update.
     """
 
     directory: str
     prefix: str
     suffix: str
+    version: str
 
-    def __init__(self, directory: str, prefix: str, suffix: str):
+    def __init__(self, directory: str, prefix: str, suffix: str, version: str = "v1"):
         """
-        Constructs a new `Cache`.
+        Constructs a new `Cache`, and evicts cached data stored under a version other than [version].
 
         :param directory: the directory to store cached files in
         :param prefix: the string to prefix all cached files with
         :param suffix: the string to suffix all cached files with
+        :param version: the version of the code that produces the cached data
         """
 
+        if "-" in version:
+            raise Exception(f"Version must not contain '-', but was '{version}'.")
+
         Files.mkdir(directory)
 
         self.directory = directory
         self.prefix = prefix
         self.suffix = suffix
+        self.version = version
+
+        self._evict_other_versions()
+
+    def _evict_other_versions(self) -> None:
+        """
+        Removes all cached data that was stored under a version other than [self.version].
+
+        :return: `None`
+        """
+
+        for path in Path(self.directory).glob(f"{self.prefix}-*{self.suffix}"):
+            infix = path.name[len(self.prefix) + 1:len(path.name) - len(self.suffix)]
+            parts = infix.split("-")
+            if len(parts) != 3 or parts[1] != self.version:
+                path.unlink()
 
     def path(self, key: str, state: str) -> Path:
         """
@@ -52,7 +77,7 @@ class Cache(ABC, Generic[T]):
         :return: the path to the data cached under [key] and [state]
         """
 
-        return Path(f"{self.directory}/{self.prefix}-{key}-{state}{self.suffix}")
+        return Path(f"{self.directory}/{self.prefix}-{key}-{self.version}-{state}{self.suffix}")
 
     def path_all(self, key: str) -> List[Path]:
         """
@@ -113,6 +138,30 @@ class Cache(ABC, Generic[T]):
 
         return path
 
+    def cache_link(self, source: Path, key: str, state: str = "") -> Path:
+        """
+        Removes all other data cached under [key], and caches the already-serialized file at [source] under [key] and
+        [state] by hardlinking it, without re-serializing any data.
+
+        :param source: the path to an existing file containing the serialized datum to cache
+        :param key: the key to cache [source] under
+        :param state: the state to cache [source] under
+        :return: the path under which [source] has been stored
+        """
+
+        if "-" in key:
+            raise Exception(f"Key must not contain '-', but was '{key}'.")
+        if "-" in state:
+            raise Exception(f"State must not contain '-', but was '{state}'.")
+
+        for path in self.path_all(key):
+            path.unlink()
+
+        path = self.path(key, state)
+        os.link(source, path)
+
+        return path
+
     @abstractmethod
     def _write_data(self, path: Path, data: T) -> None:
         """
@@ -143,21 +192,29 @@ class ImageCache(Cache[Image.Image]):
     """
 
     def _write_data(self, path: Path, data: Image.Image) -> None:
-        data.save(path)
+        # Cached images are re-encoded every time a stage misses the cache, so encode at high quality to prevent
+        # generational quality loss across stages
+        data.save(path, quality=95)
 
     def _read_data(self, path: Path) -> Image.Image:
         return load_image(path)
 
 
-class NdarrayCache(Cache[np.ndarray]):
+class PickleCache(Cache[T]):
     """
-    Caches arbitrary Numpy arrays.
+    Caches arbitrary picklable values.
     """
 
-    def _write_data(self, path: Path, data: np.ndarray) -> None:
+    def _write_data(self, path: Path, data: T) -> None:
         with open(path, "wb") as file:
             pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
 
-    def _read_data(self, path: Path) -> np.ndarray:
+    def _read_data(self, path: Path) -> T:
         with open(path, "rb") as file:
             return pickle.load(file)
+
+
+class NdarrayCache(PickleCache[np.ndarray]):
+    """
+    Caches arbitrary Numpy arrays.
+    """
@@ -1,9 +1,12 @@
+import functools
 from importlib.machinery import SourceFileLoader
-from typing import TypedDict
+from pathlib import Path
+from typing import Dict, TypedDict
 
 from mergedeep import merge
 from typeguard import check_type
 
+import Hasher
 import Resolver
 from Pipeline import PipelineConfig
 from UserException import UserException
@@ -17,6 +20,38 @@ FacemationConfig = TypedDict("FacemationConfig", {"pipeline": PipelineConfig,
                                                   "ffmpeg": FfmpegConfig})
 
 
+@functools.lru_cache(maxsize=8)
+def _load_module_config(path: str, mtime_ns: int) -> Dict:
+    """
+    Executes the Python file at [path] and returns its `config` variable.
+
+    Results are memoized by [path] and [mtime_ns], so that repeatedly loading an unchanged file does not re-execute it.
+
+    :param path: the path to the Python file to load config from
+    :param mtime_ns: the modification time of [path], to invalidate the memoized result when the file changes
+    :return: the `config` variable of the Python file at [path]
+    """
+
+    # A unique module name per file gives each load a fresh namespace; reusing a single name would execute each
+    # subsequent file inside the previous file's module
+    return SourceFileLoader(f"cfg_{Hasher.hash_string(path)}", path).load_module().config
+
+
+def _read_config(path: Path) -> Dict:
+    """
+    Returns the config from the Python file at [path], or an empty dict if [path] does not exist.
+
+    :param path: the path to the Python file to load config from
+    :return: the config from the Python file at [path], or an empty dict if [path] does not exist
+    """
+
+    if not path.exists():
+        return {}
+
+    path = path.resolve()
+    return _load_module_config(str(path), path.stat().st_mtime_ns)
+
+
 def load_config() -> FacemationConfig:
     """
     Loads config from `config_default.py`, overrides it with `config.py` (if it exists) in the same directory as the
@@ -28,20 +63,9 @@ def load_config() -> FacemationConfig:
     :return: the combined configuration
     """
 
-    cfg_default_path = Resolver.resource_path("config_default.py")
-    cfg_default = SourceFileLoader("cfg_default", str(cfg_default_path)).load_module().config
-
-    cfg_user_path = Resolver.exe_relative_path("config.py")
-    if cfg_user_path.exists():
-        cfg_user = SourceFileLoader("cfg_user", str(cfg_user_path.resolve())).load_module().config
-    else:
-        cfg_user = {}
-
-    cfg_dev_path = Resolver.cwd_relative_path("config_dev.py")
-    if cfg_dev_path.exists():
-        cfg_dev = SourceFileLoader("cfg_dev", str(cfg_dev_path.resolve())).load_module().config
-    else:
-        cfg_dev = {}
+    cfg_default = _read_config(Resolver.resource_path("config_default.py"))
+    cfg_user = _read_config(Resolver.exe_relative_path("config.py"))
+    cfg_dev = _read_config(Resolver.cwd_relative_path("config_dev.py"))
 
     cfg = merge({}, cfg_default, cfg_dev, cfg_user)
     try:
@@ -1,17 +1,60 @@
+import atexit
 import shutil
+import threading
+import uuid
 from pathlib import Path
+from typing import List
+
+_delete_threads: List[threading.Thread] = []
+
+
+def _delete_in_background(path: Path) -> None:
+    """
+    Recursively deletes the directory at [path] in a background thread.
+
+    All background deletions are joined when the interpreter exits, so no half-deleted directories are left behind.
+
+    :param path: the path to the directory to delete
+    :return: `None`
+    """
+
+    thread = threading.Thread(target=shutil.rmtree, args=(path,))
+    thread.start()
+    _delete_threads.append(thread)
+
+
+@atexit.register
+def _join_delete_threads() -> None:
+    """
+    Waits for all background deletions to complete.
+
+    :return: `None`
+    """
+
+    for thread in _delete_threads:
+        thread.join()
 
 
 def cleardir(path: str) -> None:
     """
-    Removes all files at [path] by removing the directory and then re-creating it.
+    Removes all files at [path] by renaming the directory aside and re-creating it, deleting the renamed directory in
+    the background so the caller does not wait for the potentially slow recursive delete.
 
     :param path: the path to the directory to empty
     :return: `None`
     """
 
-    if Path(path).exists():
-        shutil.rmtree(path)
+    path = Path(path)
+
+    # Also delete directories left behind if an earlier run was killed before its background deletion finished
+    if path.parent.exists():
+        for leftover_path in path.parent.glob(f"{path.name}.deleting-*"):
+            _delete_in_background(leftover_path)
+
+    if path.exists():
+        doomed_path = path.with_name(f"{path.name}.deleting-{uuid.uuid4().hex}")
+        path.rename(doomed_path)
+        _delete_in_background(doomed_path)
 
     mkdir(path)
 
@@ -1,6 +1,9 @@
-import base64
+import binascii
 import hashlib
 
+# Translates standard base64 to "+,"-base64
+_b64_altchars = bytes.maketrans(b"+/", b"+,")
+
 
 def _tob64(digest: bytes) -> str:
     """
@@ -10,37 +13,26 @@ def _tob64(digest: bytes) -> str:
     :return: [digest] as a "+,"-base64-string
     """
 
-    return base64.b64encode(digest, altchars=b"+,").decode()
+    return binascii.b2a_base64(digest, newline=False).translate(_b64_altchars).decode()
 
 
-def hash_file(filename: str) -> str:
+def hash_bytes(data: bytes) -> str:
     """
-    Calculates the "+,"-base64-encoded SHA3 hash of the contents of [filename].
-
-    Taken from https://stackoverflow.com/a/44873382.
+    Calculates the "+,"-base64-encoded BLAKE2 hash of [data].
 
-    :param filename: the path to the file to calculate the hash of
-    :return: the SHA3 hash of the contents of [filename]
+    :param data: the bytes to calculate the hash of
+    :return: the BLAKE2 hash of [data]
     """
 
-    h = hashlib.shake_128()
-
-    b = bytearray(128 * 1024)
-    mv = memoryview(b)
-    with open(filename, "rb", buffering=0) as file:
-        # noinspection PyUnresolvedReferences
-        while n := file.readinto(mv):
-            h.update(mv[:n])
-
-    return _tob64(h.digest(64))
+    return _tob64(hashlib.blake2b(data, digest_size=64).digest())
 
 
 def hash_string(string: str) -> str:
     """
-    Calculates the "+,"-base64-encoded SHA3 hash of [string].
+    Calculates the "+,"-base64-encoded BLAKE2 hash of [string].
 
     :param string: the string to calculate the hash of
-    :return: the SHA3 hash of [string]
+    :return: the BLAKE2 hash of [string]
     """
 
-    return _tob64(hashlib.shake_128(string.encode("utf-8")).digest(64))
+    return _tob64(hashlib.blake2b(string.encode("utf-8"), digest_size=64).digest())
@@ -1,21 +1,34 @@
-import copy
 import os
 from abc import ABC, abstractmethod
 from pathlib import Path
 from typing import List, Dict, Any, TypedDict
 
-import PIL
-from PIL import Image
-from mergedeep import merge
-from natsort import natsorted
+from natsort import natsort_keygen
 
 import Files
 from UserException import UserException
 
+# Constructing the key function once avoids natsort's per-call dispatch overhead
+natural_sort_key = natsort_keygen()
+
 PipelineConfig = TypedDict("PipelineConfig", {"input_dir": str, "cache_dir": str, "frames_dir": str})
 ImageInfo = Dict[str, Any]  # Contains `processed_path` during processing, and `frame_path` during postprocessing
 
 
+def snapshot(imgs: Dict[Path, ImageInfo]) -> Dict[Path, ImageInfo]:
+    """
+    Returns a copy of [imgs] with a fresh dict per image, sharing the stored values.
+
+    Stages receive such a snapshot so that they cannot modify the pipeline's own mapping, but the values themselves are
+    not copied; stages must treat them as read-only.
+
+    :param imgs: the mapping to copy
+    :return: a copy of [imgs] with a fresh dict per image, sharing the stored values
+    """
+
+    return {img_path: dict(img_data) for img_path, img_data in imgs.items()}
+
+
 class Stage(ABC):
     """
     A part of the [Pipeline].
@@ -45,7 +58,8 @@ class ProcessingStage(Stage):
     """
     Processes images into new images.
 
-    Processing stages are typically chained together.
+    Processing stages are typically chained together, each reading its input from the previous stage's
+    `"processed_path"`.
     """
 
     @abstractmethod
@@ -120,7 +134,7 @@ class Pipeline:
         """
         Executes all [self.preprocessing] stages and returns the obtained data.
 
-        Raises a [UserException] if no supported images are found in [input_dir].
+        Raises a [UserException] if no images are found in [input_dir].
 
         :param input_dir: the directory containing the images to preprocess
         :return: a mapping from original input path to the preprocessed data
@@ -128,19 +142,18 @@ class Pipeline:
 
         Files.mkdir(input_dir)
 
-        img_paths = [it for it in Path(input_dir).iterdir() if it.is_file()]
+        # `os.scandir` reads the file type together with the directory entry, avoiding a `stat` call per file
+        with os.scandir(input_dir) as entries:
+            img_paths = [Path(it.path) for it in entries if it.is_file()]
         if len(img_paths) == 0:
             raise UserException(f"No images detected in '{Path(input_dir).resolve()}'. "
                                 f"Are you sure you put them in the right place?", )
-        for img_path in img_paths:
-            try:
-                Image.open(img_path)
-            except PIL.UnidentifiedImageError:
-                raise UserException(f"Unsupported image type for input '{img_path}'.")
 
         imgs = {Path(it): {} for it in img_paths}
         for stage in self.preprocessing:
-            merge(imgs, stage.preprocess(copy.deepcopy(imgs)))
+            # Stages only add top-level fields per image, so a targeted update suffices; no recursive merge is needed
+            for img_path, img_data in stage.preprocess(snapshot(imgs)).items():
+                imgs[img_path].update(img_data)
         return imgs
 
     def process(self, imgs: Dict[Path, ImageInfo], frames_dir: str) -> Dict[Path, ImageInfo]:
@@ -152,19 +165,35 @@ class Pipeline:
         :return: a copy of [imgs] with `"processed_path"` pointing to the newly processed images
         """
 
-        Files.cleardir(frames_dir)
+        Files.mkdir(frames_dir)
 
-        processed_imgs = copy.deepcopy(imgs)
+        processed_imgs = snapshot(imgs)
         for img_path in list(processed_imgs.keys()):
             processed_imgs[img_path]["processed_path"] = img_path
 
         for stage in self.processing:
-            processed_imgs = stage.process(copy.deepcopy(processed_imgs))
-
-        for idx, img_path in enumerate(natsorted(processed_imgs.keys())):
-            frame_path = f"{frames_dir}/{idx}.jpg"
-            os.link(processed_imgs[img_path]["processed_path"].resolve(), frame_path)
-            processed_imgs[img_path]["frame_path"] = frame_path
+            processed_imgs = stage.process(snapshot(processed_imgs))
+
+        # Diff the desired frames against what is already in [frames_dir], so that a re-run in which most images were
+        # cache hits only touches the frames that actually changed instead of recreating every hardlink
+        desired = {}
+        for idx, img_path in enumerate(sorted(processed_imgs.keys(), key=natural_sort_key)):
+            desired[f"{idx}.jpg"] = processed_imgs[img_path]["processed_path"]
+            processed_imgs[img_path]["frame_path"] = f"{frames_dir}/{idx}.jpg"
+
+        with os.scandir(frames_dir) as entries:
+            existing = {it.name: it.inode() for it in entries}
+
+        for name in existing.keys() - desired.keys():
+            os.unlink(f"{frames_dir}/{name}")
+        for name, processed_path in desired.items():
+            if name in existing:
+                # Frames are hardlinks into the caches, so an equal inode means the frame is already up to date
+                if existing[name] == os.stat(processed_path).st_ino:
+                    continue
+                os.unlink(f"{frames_dir}/{name}")
+            # `os.link` resolves paths itself; calling `resolve()` here would stat every path component per image
+            os.link(processed_path, f"{frames_dir}/{name}")
 
         return processed_imgs
 
@@ -180,13 +209,13 @@ class Pipeline:
         """
 
         for stage in self.postprocessing:
-            stage.postprocess(copy.deepcopy(imgs), frames_dir)
+            stage.postprocess(snapshot(imgs), frames_dir)
 
     def run(self, input_dir: str, frames_dir: str) -> None:
         """
         Runs the pipeline from start to end.
 
-        Raises a [UserException] if no supported images are found in [input_dir].
+        Raises a [UserException] if no images are found in [input_dir].
 
         :param input_dir: the directory containing the images to process
         :param frames_dir: the directory to store processed frames in
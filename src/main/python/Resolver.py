@@ -3,6 +3,42 @@ import sys
 from pathlib import Path
 
 
+def _find_exe_base_path() -> Path:
+    """
+    Returns the path to the directory containing the invoked executable.
+
+    :return: the path to the directory containing the invoked executable
+    """
+
+    if getattr(sys, "frozen", False):
+        if "STATICX_PROG_PATH" in os.environ:
+            return Path(os.environ["STATICX_PROG_PATH"]).parent
+        else:
+            return Path(sys.executable).parent
+    else:
+        return Path(__file__).parent
+
+
+def _find_resource_base_path() -> Path:
+    """
+    Returns the path to the directory containing bundled resources.
+
+    :return: the path to the directory containing bundled resources
+    """
+
+    if getattr(sys, "frozen", False):
+        # noinspection PyProtectedMember,PyUnresolvedReferences
+        return Path(sys._MEIPASS)
+    else:
+        return _exe_base_path.joinpath("../resources/")
+
+
+# How the program was started cannot change while it runs, so resolve the base paths once at import instead of
+# re-inspecting `sys` and the environment on every call
+_exe_base_path = _find_exe_base_path()
+_resource_base_path = _find_resource_base_path()
+
+
 def cwd_relative_path(relative_path: str) -> Path:
     """
     Returns the path to the file at [relative_path] relative to the current working directory.
@@ -22,15 +58,7 @@ def exe_relative_path(relative_path: str) -> Path:
     :return: the path to the file at [relative_path] relative to the invoked executable
     """
 
-    if getattr(sys, "frozen", False):
-        if "STATICX_PROG_PATH" in os.environ:
-            base_path = Path(os.environ["STATICX_PROG_PATH"]).parent
-        else:
-            base_path = Path(sys.executable).parent
-    else:
-        base_path = Path(__file__).parent
-
-    return base_path.joinpath(relative_path)
+    return _exe_base_path.joinpath(relative_path)
 
 
 def resource_path(path: str) -> Path:
@@ -44,10 +72,4 @@ def resource_path(path: str) -> Path:
     :return: the path to the resource at [relative_path]
     """
 
-    if getattr(sys, "frozen", False):
-        # noinspection PyProtectedMember,PyUnresolvedReferences
-        base_path = Path(sys._MEIPASS)
-    else:
-        base_path = exe_relative_path("../resources/")
-
-    return base_path.joinpath(path)
+    return _resource_base_path.joinpath(path)
@@ -42,7 +42,7 @@ def main() -> None:
     cfg = load_config()
 
     pipeline = Pipeline()
-    pipeline.register(ReadMetadataStage())
+    pipeline.register(ReadMetadataStage(cfg["pipeline"]["cache_dir"]))
     pipeline.register(FindFacesStage(cfg["find_faces"], cfg["pipeline"]["cache_dir"]))
     pipeline.register(NormalizeStage(cfg["pipeline"]["cache_dir"]))
     if cfg["caption"]["enabled"]:
@@ -1,16 +1,17 @@
-import copy
+import functools
+import math
 import sys
 from pathlib import Path
-from typing import Callable, Dict, TypedDict
+from typing import Callable, Dict, Tuple, TypedDict
 
 from PIL import ImageDraw, ImageFont
-from tqdm import tqdm
+from tqdm.contrib.concurrent import process_map
 
 import Hasher
 import Resolver
 from Cache import ImageCache
 from ImageLoader import load_image
-from Pipeline import ImageInfo, ProcessingStage
+from Pipeline import ImageInfo, ProcessingStage, snapshot
 
 CaptionGenerator = Callable[[str], str]
 CaptionConfig = TypedDict("CaptionConfig", {"enabled": bool,
@@ -33,7 +34,7 @@ class CaptionStage(ProcessingStage):
         :param caption_generator: generates a caption based on the filename
         """
 
-        self.captioned_cache = ImageCache(cache_dir, "captioned", ".jpg")
+        self.captioned_cache = ImageCache(cache_dir, "captioned", ".jpg", version="v4")
         self.caption_generator = caption_generator
 
     def process(self, imgs: Dict[Path, ImageInfo]) -> Dict[Path, ImageInfo]:
@@ -44,27 +45,77 @@ class CaptionStage(ProcessingStage):
         :return: a copy of [imgs] with `"processed_path"` pointing to the newly processed images
         """
 
-        processed_imgs = copy.deepcopy(imgs)
+        # A snapshot suffices: stages only add or replace top-level fields, and shared values are treated as read-only
+        processed_imgs = snapshot(imgs)
 
-        for img_path, img_data in tqdm(imgs.items(), desc="Adding captions", file=sys.stdout):
-            caption = str(self.caption_generator(img_path.name))
+        # Generate all captions up front, so that a broken caption generator fails before any image is processed
+        captions = {it: str(self.caption_generator(it.name)) for it in imgs.keys()}
+
+        # Resolve cache hits in the parent process, so that workers are spawned only for images that need actual work
+        todo = []
+        for img_path, img_data in imgs.items():
+            caption = captions[img_path]
+
+            # The processed image is a cache file whose name already encodes its key, version, and state, so the name
+            # identifies the contents without re-reading and hashing the file
+            state_hash = Hasher.hash_string(f"{img_data['processed_path'].name} {caption}")
 
-            processed_img_hash = Hasher.hash_file(img_data["processed_path"])
-            state_hash = Hasher.hash_string(f"{processed_img_hash}-{caption}")
             if self.captioned_cache.has(img_data["hash"], state_hash):
                 processed_imgs[img_path]["processed_path"] = self.captioned_cache.path(img_data["hash"], state_hash)
-                continue
+            elif caption == "":
+                # An empty caption leaves the image unchanged, so hardlink the processed file instead of re-encoding it
+                processed_imgs[img_path]["processed_path"] = \
+                    self.captioned_cache.cache_link(img_data["processed_path"], img_data["hash"], state_hash)
+            else:
+                todo.append((img_path, img_data["hash"], img_data["processed_path"], caption, state_hash))
+
+        if len(todo) > 0:
+            results = process_map(functools.partial(caption_image, captioned_cache=self.captioned_cache),
+                                  todo,
+                                  desc="Adding captions",
+                                  chunksize=math.ceil(len(todo) / 250),
+                                  file=sys.stdout)
+            for img_path, processed_path in results:
+                processed_imgs[img_path]["processed_path"] = processed_path
 
-            img = load_image(img_data["processed_path"])
+        return processed_imgs
 
-            width, height = img.size
-            pos = (0.05 * width, 0.90 * height)
-            font = ImageFont.truetype(str(Resolver.resource_path("Roboto-Regular.ttf")), int(0.05 * height))
 
-            img_draw = ImageDraw.Draw(img)
-            img_draw.text(pos, caption, font=font, stroke_fill=(0, 0, 0), stroke_width=8)
-            img_draw.text(pos, caption, font=font, stroke_fill=(255, 255, 255), stroke_width=1)
+def caption_image(img_tuple: Tuple[Path, str, Path, str, str], captioned_cache: ImageCache) -> Tuple[Path, Path]:
+    """
+    Draws the caption in [img_tuple] onto the image in [img_tuple], storing the result in [captioned_cache].
 
-            processed_imgs[img_path]["processed_path"] = self.captioned_cache.cache(img, img_data["hash"], state_hash)
+    :param img_tuple: the original input path, the image's hash, the processed input path, the caption, and the state
+    hash of the image to caption
+    :param captioned_cache: the cache to store the captioned image in
+    :return: the original input path and the path to the captioned image
+    """
 
-        return processed_imgs
+    img_path, img_hash, processed_path, caption, state_hash = img_tuple
+
+    img = load_image(processed_path)
+
+    width, height = img.size
+    pos = (0.05 * width, 0.90 * height)
+    font = get_font(height)
+
+    # A single stroked draw renders the white fill and black outline in one pass over the glyph pixels
+    img_draw = ImageDraw.Draw(img)
+    img_draw.text(pos, caption, fill=(255, 255, 255), font=font, stroke_fill=(0, 0, 0), stroke_width=8)
+
+    return img_path, captioned_cache.cache(img, img_hash, state_hash)
+
+
+@functools.lru_cache(maxsize=8)
+def get_font(img_height: int) -> ImageFont.FreeTypeFont:
+    """
+    Returns the caption font, sized for an image of height [img_height].
+
+    All images share one resolution after normalization, so memoizing on the height parses the font file once per
+    worker instead of once per image.
+
+    :param img_height: the height of the image to caption, in pixels
+    :return: the caption font, sized for an image of height [img_height]
+    """
+
+    return ImageFont.truetype(str(Resolver.resource_path("Roboto-Regular.ttf")), int(0.05 * img_height))
@@ -5,7 +5,7 @@ from pathlib import Path
 from typing import Dict, TypedDict, List, Union
 
 import Files
-from Pipeline import PostprocessingStage, ImageInfo
+from Pipeline import PostprocessingStage, ImageInfo, natural_sort_key
 from UserException import UserException
 
 FfmpegConfig = TypedDict("FfmpegConfig", {"enabled": bool,
@@ -13,6 +13,7 @@ FfmpegConfig = TypedDict("FfmpegConfig", {"enabled": bool,
                                           "output_path": str,
                                           "fps": Union[str, int],
                                           "codec": str,
+                                          "preset": str,
                                           "crf": Union[str, int],
                                           "video_filters": List[str],
                                           "custom_global_options": List[str],
@@ -55,17 +56,27 @@ class FfmpegStage(PostprocessingStage):
         :return: `None`
         """
 
+        # A concat list makes the frame order explicit, so FFmpeg does not have to probe for a numbered pattern. The
+        # demuxer resolves entries relative to the list file, which sits next to the frames, so writing bare frame
+        # names keeps user-controlled characters such as apostrophes in the installation path out of the list entirely
+        frame_names = sorted((Path(it["frame_path"]).name for it in imgs.values()), key=natural_sort_key)
+        concat_list_path = Path(frames_dir, "frames.txt")
+        with open(concat_list_path, "w") as file:
+            file.writelines([f"file '{it}'\n" for it in frame_names])
+
         args = [self.cfg["exe_path"]]
         args += ["-hide_banner"]
         args += ["-loglevel", "error"]
         args += ["-stats"]
         args += ["-y"]
-        args += ["-f", "image2"]
+        args += ["-f", "concat"]
         args += ["-r", str(self.cfg["fps"])]
         args += self.cfg["custom_global_options"]
-        args += ["-i", f"{frames_dir}/%d.jpg"]
+        args += ["-i", str(concat_list_path)]
         args += self.cfg["custom_inputs"]
         args += ["-vcodec", self.cfg["codec"]]
+        if self.cfg["preset"] != "":
+            args += ["-preset", str(self.cfg["preset"])]
         args += ["-crf", str(self.cfg["crf"])]
         if len(self.cfg["video_filters"]) > 0:
             args += ["-vf", ",".join(self.cfg["video_filters"])]
@@ -8,6 +8,7 @@ import dill as dill
 import dlib
 import numpy as np
 from PIL import ImageDraw
+from tqdm import tqdm
 from tqdm.contrib.concurrent import process_map
 
 import Files
@@ -19,10 +20,48 @@ from UserException import UserException
 
 FaceSelectionOverride = Callable[[dlib.full_object_detection], int]
 FindFacesConfig = TypedDict("FindFacesConfig", {"error_dir": str,
+                                                "detection_width": int,
                                                 "face_selection_overrides": Dict[str, FaceSelectionOverride]})
 Face = np.ndarray  # (x, y)-coordinates of the eyes, with the left-most eye in the picture as the first row
 
 
+@functools.lru_cache(maxsize=1)
+def get_detector() -> dlib.fhog_object_detector:
+    """
+    Returns the dlib face detector, constructing it on the first call in each process.
+
+    :return: the dlib face detector
+    """
+
+    return dlib.get_frontal_face_detector()
+
+
+@functools.lru_cache(maxsize=1)
+def get_shape_predictor() -> dlib.shape_predictor:
+    """
+    Returns the dlib shape predictor, loading it from disk on the first call in each process.
+
+    :return: the dlib shape predictor
+    """
+
+    return dlib.shape_predictor(str(Resolver.resource_path("shape_predictor_5_face_landmarks.dat")))
+
+
+@functools.lru_cache(maxsize=1)
+def load_face_selection_overrides(serialized: bytes) -> Dict[str, FaceSelectionOverride]:
+    """
+    Deserializes the face selection overrides in [serialized], memoizing the result per process.
+
+    The overrides contain user-defined functions and must travel to the workers as a dill serialization; memoizing the
+    deserialization means each worker pays for it once instead of once per image.
+
+    :param serialized: dill serialization of the face selection overrides
+    :return: the deserialized face selection overrides
+    """
+
+    return dill.loads(serialized)
+
+
 class FindFacesStage(PreprocessingStage):
     """
     Finds faces in the input images.
@@ -42,7 +81,7 @@ class FindFacesStage(PreprocessingStage):
         Files.cleardir(cfg["error_dir"])
 
         self.cfg = cfg
-        self.face_cache = NdarrayCache(cache_dir, "face", ".cache")
+        self.face_cache = NdarrayCache(cache_dir, "face", ".cache", version="v2")
 
     def preprocess(self, imgs: Dict[Path, ImageInfo]) -> Dict[Path, ImageInfo]:
         """
@@ -57,19 +96,34 @@ class FindFacesStage(PreprocessingStage):
         :return: a mapping from original input path to the face in the image
         """
 
-        return dict(process_map(functools.partial(find_face,
-                                                  face_cache=self.face_cache,
-                                                  face_selection_overrides=dill.dumps(
-                                                      self.cfg["face_selection_overrides"], recurse=True),
-                                                  error_dir=self.cfg["error_dir"]),
-                                imgs.items(),
-                                desc="Detecting faces",
-                                chunksize=math.ceil(len(imgs) / 250),
-                                file=sys.stdout))
-
-
-def find_face(img_tuple: Tuple[Path, ImageInfo], face_cache: NdarrayCache, face_selection_overrides: bytes,
-              error_dir: str) -> Tuple[Path, ImageInfo]:
+        # Resolve cache hits in the parent process, so that workers are spawned only for images that need actual work
+        faces = {img_path: {"eyes": self.face_cache.load(img_data["hash"])}
+                 for img_path, img_data in imgs.items() if self.face_cache.has(img_data["hash"])}
+        todo = {img_path: img_data for img_path, img_data in imgs.items() if img_path not in faces}
+
+        if len(todo) > 0:
+            find = functools.partial(find_face,
+                                     face_cache=self.face_cache,
+                                     detection_width=self.cfg["detection_width"],
+                                     face_selection_overrides=dill.dumps(self.cfg["face_selection_overrides"],
+                                                                         recurse=True),
+                                     error_dir=self.cfg["error_dir"])
+
+            if len(todo) <= 4:
+                # Spawning a pool costs more than detecting a handful of faces, so run small batches in this process
+                faces.update(map(find, tqdm(todo.items(), desc="Detecting faces", file=sys.stdout)))
+            else:
+                faces.update(process_map(find,
+                                         todo.items(),
+                                         desc="Detecting faces",
+                                         chunksize=math.ceil(len(todo) / 250),
+                                         file=sys.stdout))
+
+        return faces
+
+
+def find_face(img_tuple: Tuple[Path, ImageInfo], face_cache: NdarrayCache, detection_width: int,
+              face_selection_overrides: bytes, error_dir: str) -> Tuple[Path, ImageInfo]:
     """
     Finds the face in [img_tuple], expressed as the positions of the eyes, caching the face data in [face_cache].
 
@@ -79,6 +133,7 @@ def find_face(img_tuple: Tuple[Path, ImageInfo], face_cache: NdarrayCache, face_
 
     :param img_tuple: the original input path and the pre-processing data of the image to find a face in
     :param face_cache: the cache to store the found face in
+    :param detection_width: the width to downscale the image to before running face detection
     :param face_selection_overrides: dill serialization of dictionary from image names to sorting function to select
     which face to use in case an image has multiple faces
     :param error_dir: the directory to write debugging information in to assist the user
@@ -86,21 +141,32 @@ def find_face(img_tuple: Tuple[Path, ImageInfo], face_cache: NdarrayCache, face_
     """
 
     img_path, img_data = img_tuple
-    if face_cache.has(img_data["hash"]):
-        return img_path, {"eyes": face_cache.load(img_data["hash"])}
 
     # Initialize face recognition
-    face_selection_overrides = dill.loads(face_selection_overrides)
-    detector = dlib.get_frontal_face_detector()
-    shape_predictor = dlib.shape_predictor(str(Resolver.resource_path("shape_predictor_5_face_landmarks.dat")))
+    detector = get_detector()
+    shape_predictor = get_shape_predictor()
+
+    face_selection_overrides = load_face_selection_overrides(face_selection_overrides)
 
     # Find face
+    # Detection cost grows with the number of pixels, so detect on a downscaled copy, but predict landmarks on the
+    # full-size image so that the eye positions do not lose precision
     img = load_image(img_path)
     img_np = np.array(img)
-    faces = dlib.full_object_detections()
-    detections = detector(img_np, 1)
-    for detection in detections:
-        faces.append(shape_predictor(img_np, detection))
+    scale = min(1.0, detection_width / img.width)
+    if scale < 1.0:
+        detection_img_np = np.array(img.resize((round(scale * img.width), round(scale * img.height))))
+    else:
+        detection_img_np = img_np
+
+    detections = detector(detection_img_np, 1)
+    # The downscaled copy is only needed for detection; drop it so each worker holds one extra image at peak, not two
+    del detection_img_np
+    if scale < 1.0:
+        detections = [dlib.rectangle(round(it.left() / scale), round(it.top() / scale),
+                                     round(it.right() / scale), round(it.bottom() / scale)) for it in detections]
+    # A plain list suffices downstream; constructing dlib's detections container would be pure per-image overhead
+    faces = [shape_predictor(img_np, it) for it in detections]
 
     # Determine what to do if there are multiple faces
     if len(faces) == 0:
@@ -111,7 +177,7 @@ def find_face(img_tuple: Tuple[Path, ImageInfo], face_cache: NdarrayCache, face_
         img_name = img_path.name  # Includes file extension
 
         if img_name in face_selection_overrides:
-            face = sorted(list(faces), key=face_selection_overrides[img_name])[0]
+            face = sorted(faces, key=face_selection_overrides[img_name])[0]
         else:
             img_draw = ImageDraw.Draw(img)
 
@@ -130,8 +196,8 @@ def find_face(img_tuple: Tuple[Path, ImageInfo], face_cache: NdarrayCache, face_
                                 f"see 'config_default.py' for more information.")
 
     # Store results
-    eyes = np.vstack([(np.mean(np.array([(face.part(i).x, face.part(i).y) for i in range(2, 4)]), axis=0)),
-                      (np.mean(np.array([(face.part(i).x, face.part(i).y) for i in range(0, 2)]), axis=0))])
+    landmarks = np.array([(part.x, part.y) for part in face.parts()])
+    eyes = np.vstack([landmarks[2:4].mean(axis=0), landmarks[0:2].mean(axis=0)])
     face_cache.cache(eyes, img_data["hash"])
 
     return img_path, {"eyes": eyes}
@@ -1,18 +1,18 @@
-import copy
+import functools
 import math
 import sys
 import warnings
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Tuple
 
 import numpy as np
 from PIL import Image
-from tqdm import tqdm
+from tqdm.contrib.concurrent import process_map
 
 import Hasher
 from Cache import ImageCache
 from ImageLoader import load_image
-from Pipeline import ProcessingStage, ImageInfo
+from Pipeline import ProcessingStage, ImageInfo, snapshot
 from UserException import UserException
 
 
@@ -30,7 +30,7 @@ class NormalizeStage(ProcessingStage):
         :param cache_dir: the directory to store normalized images in
         """
 
-        self.normalized_cache = ImageCache(cache_dir, "normalized", ".jpg")
+        self.normalized_cache = ImageCache(cache_dir, "normalized", ".jpg", version="v4")
 
     def process(self, imgs: Dict[Path, ImageInfo]) -> Dict[Path, ImageInfo]:
         """
@@ -40,53 +40,52 @@ class NormalizeStage(ProcessingStage):
         :return: a copy of [imgs] with `"processed_path"` pointing to the newly processed images
         """
 
-        img_paths = imgs.keys()
-        eyes = {it: imgs[it]["eyes"] for it in img_paths}
+        img_paths = list(imgs.keys())
+        eyes = np.stack([imgs[it]["eyes"] for it in img_paths])
+        img_dims = np.array([imgs[it]["dims"] for it in img_paths])
 
         # Find scale for resizing
-        eye_dists = {it: math.dist(eyes[it][0], eyes[it][1]) for it in img_paths}
-        min_eye_dist = np.min(np.array(list(eye_dists.values())))
-        scales = {it: min_eye_dist / eye_dists[it] for it in img_paths}
-        scaled_img_dims = {it: (scales[it] * imgs[it]["dims"]).astype(int) for it in img_paths}
+        eye_dists = np.linalg.norm(eyes[:, 0] - eyes[:, 1], axis=1)
+        scales = np.min(eye_dists) / eye_dists
+        scaled_img_dims = (scales[:, np.newaxis] * img_dims).astype(int)
 
         # Find translation to align eyes
-        eye_centers = {it: np.mean([eyes[it][0], eyes[it][1]], axis=0).astype(int) for it in img_paths}
-        scaled_eye_centers = {it: (scales[it] * eye_centers[it]).astype(int) for it in img_paths}
-        max_scaled_eye_center = np.max(np.array(list(scaled_eye_centers.values())), axis=0)
-        translations = {it: max_scaled_eye_center - scaled_eye_centers[it] for it in img_paths}
+        eye_centers = ((eyes[:, 0] + eyes[:, 1]) / 2).astype(int)
+        scaled_eye_centers = (scales[:, np.newaxis] * eye_centers).astype(int)
+        max_scaled_eye_center = np.max(scaled_eye_centers, axis=0)
+        translations = max_scaled_eye_center - scaled_eye_centers
 
         # Find rotation angle
         # Note that angle is negated because y-axis is flipped by OpenCV, so positive angle is clockwise rotation
-        scaled_relative_right_eye_positions = \
-            {it: scales[it] * eyes[it][1] - scaled_eye_centers[it] for it in img_paths}
-        angles = {k: -math.atan2(v[1], v[0]) for k, v in scaled_relative_right_eye_positions.items()}
+        scaled_relative_right_eye_positions = scales[:, np.newaxis] * eyes[:, 1] - scaled_eye_centers
+        angles = -np.arctan2(scaled_relative_right_eye_positions[:, 1], scaled_relative_right_eye_positions[:, 0])
 
         # Find cropping boundaries
-        img_corners_after_rotation = {it: rotate(max_scaled_eye_center,
-                                                 translations[it] + get_corners(scaled_img_dims[it]),
-                                                 angles[it]) for it in img_paths}
-        img_inner_boundaries = {it: largest_inner_rectangle(img_corners_after_rotation[it]) for it in img_paths}
-        min_inner_boundaries = rectangle_overlap(np.array(list(img_inner_boundaries.values())))
+        # Rotate the corners of all images around the shared eye center in one batched matrix product; note that
+        # angles are negated because the y-axis is flipped, so a positive angle is a clockwise rotation
+        zeros = np.zeros(len(img_paths))
+        img_corners = np.stack([np.column_stack([scaled_img_dims[:, 0], zeros]),
+                                np.column_stack([zeros, zeros]),
+                                np.column_stack([zeros, scaled_img_dims[:, 1]]),
+                                scaled_img_dims], axis=1) + translations[:, np.newaxis, :]
+        cosines, sines = np.cos(angles), np.sin(angles)
+        rotations = np.stack([np.stack([cosines, -sines], axis=1),
+                              np.stack([sines, cosines], axis=1)], axis=1)
+        corner_offsets = img_corners - max_scaled_eye_center
+        img_corners_after_rotation = \
+            (np.einsum("nij,nkj->nki", rotations, corner_offsets) + max_scaled_eye_center).astype(int)
+        # The largest non-rotated inner rectangle of each rotated image spans the 2nd and 3rd order statistics of its
+        # corner coordinates; partitioning places those for all images in one C pass, and reducing over them directly
+        # yields the overlap of all inner rectangles without materializing the per-image rectangles
+        corner_xs = np.partition(img_corners_after_rotation[..., 0], (1, 2), axis=1)
+        corner_ys = np.partition(img_corners_after_rotation[..., 1], (1, 2), axis=1)
+        min_inner_boundaries = np.array([corner_xs[:, 1].max(), corner_ys[:, 1].max(),
+                                         corner_xs[:, 2].min(), corner_ys[:, 2].min()])
         min_inner_boundaries = (np.floor(min_inner_boundaries / 2) * 2).astype(int)
 
-        # Perform normalization
-        processed_imgs = copy.deepcopy(imgs)
-        pbar = tqdm(imgs.items(), desc="Normalizing images", file=sys.stdout)
-        for img_path, img_data in pbar:
-            eyes_string = np.array2string(eyes[img_path])
-            params_string = np.array2string(np.hstack([scales[img_path],
-                                                       translations[img_path],
-                                                       angles[img_path],
-                                                       min_inner_boundaries]))
-
-            # Skip if cached
-            state_hash = Hasher.hash_string(f"{eyes_string}-{params_string}")
-            if self.normalized_cache.has(img_data["hash"], state_hash):
-                processed_imgs[img_path]["processed_path"] = self.normalized_cache.path(img_data["hash"], state_hash)
-                continue
-
-            # Validate normalization parameters
-            angle_abs = math.fabs(math.degrees(angles[img_path]))
+        # Validate normalization parameters
+        for idx, img_path in enumerate(img_paths):
+            angle_abs = math.fabs(math.degrees(angles[idx]))
             if angle_abs >= 45.0:
                 raise UserException(f"Image '{img_path}' is rotated by {angle_abs} degrees, but Facemation only "
                                     f"supports angles up to 45 degrees (but preferably much lower). "
@@ -98,77 +97,74 @@ class NormalizeStage(ProcessingStage):
                               f"Consider manually cropping out the relevant parts of the image, or removing the image "
                               f"from the inputs altogether.")
 
-            # Normalize image
-            translated_dims = tuple(scaled_img_dims[img_path] + translations[img_path])
-            translation_matrix = (1, 0, -translations[img_path][0], 0, 1, -translations[img_path][1])
+        # Resolve cache hits in the parent process, so that workers are spawned only for images that need actual work
+        # One row per image with everything its state hash depends on, so the loop below only slices and hashes
+        state_params = np.hstack([eyes.reshape(len(img_paths), -1),
+                                  scales[:, np.newaxis],
+                                  translations,
+                                  angles[:, np.newaxis],
+                                  np.broadcast_to(min_inner_boundaries, (len(img_paths), 4))])
+
+        # A snapshot suffices: stages only add or replace top-level fields, and shared values are treated as read-only
+        processed_imgs = snapshot(imgs)
+        todo = []
+        for idx, img_path in enumerate(img_paths):
+            img_data = imgs[img_path]
+            state_hash = Hasher.hash_bytes(state_params[idx].tobytes())
 
-            img = load_image(img_data["processed_path"])
-            img = img.resize(scaled_img_dims[img_path])
-            img = img.transform(translated_dims, Image.AFFINE, translation_matrix)
-            img = img.rotate(-math.degrees(angles[img_path]), center=tuple(max_scaled_eye_center))
-            img = img.crop((min_inner_boundaries[0], min_inner_boundaries[1],
-                            min_inner_boundaries[2], min_inner_boundaries[3]))
-
-            # Store normalized image
-            processed_imgs[img_path]["processed_path"] = self.normalized_cache.cache(img, img_data["hash"], state_hash)
+            if self.normalized_cache.has(img_data["hash"], state_hash):
+                processed_imgs[img_path]["processed_path"] = self.normalized_cache.path(img_data["hash"], state_hash)
+            else:
+                todo.append((img_path, img_data, state_hash, scaled_img_dims[idx], translations[idx], angles[idx]))
+
+        if len(todo) > 0:
+            results = process_map(functools.partial(normalize_image,
+                                                    normalized_cache=self.normalized_cache,
+                                                    max_scaled_eye_center=max_scaled_eye_center,
+                                                    min_inner_boundaries=min_inner_boundaries),
+                                  todo,
+                                  desc="Normalizing images",
+                                  chunksize=math.ceil(len(todo) / 250),
+                                  file=sys.stdout)
+            for img_path, processed_path in results:
+                processed_imgs[img_path]["processed_path"] = processed_path
 
         return processed_imgs
 
 
-def get_corners(dims: np.ndarray) -> np.ndarray:
-    """
-    Returns the corners of a rectangle at `(0, 0)` with width and height as specified in [dims].
-
-    :param dims: the width and height of the rectangle
-    :return: the corners of a rectangle at `(0, 0)` with width and height as specified in [dims]
-    """
-
-    return np.array([[dims[0], 0], [0, 0], [0, dims[1]], dims])
-
-
-def rotate(origin: np.ndarray, points: np.ndarray, angle: float) -> np.ndarray:
+def normalize_image(img_tuple: Tuple[Path, ImageInfo, str, np.ndarray, np.ndarray, float],
+                    normalized_cache: ImageCache, max_scaled_eye_center: np.ndarray,
+                    min_inner_boundaries: np.ndarray) -> Tuple[Path, Path]:
     """
-    Rotates [points] around [origin] counter-clockwise by [angle] radians.
-
-    This function does not use a flipped y-axis, so "above" is positive.
-
-    :param origin: the point to rotate [points] around
-    :param points: the points to rotate around [origin] by [angle] radians
-    :param angle: the angle to rotate [points] by, in radians
-    :return: the coordinates of the rotated points
+    Translates, rotates, and resizes the image in [img_tuple], storing the result in [normalized_cache].
+
+    :param img_tuple: the original input path, the image's data, the state hash, and the scaled dimensions,
+    translation, and rotation angle of the image to normalize
+    :param normalized_cache: the cache to store the normalized image in
+    :param max_scaled_eye_center: the position to align all eye centers to
+    :param min_inner_boundaries: the rectangle to crop all images to
+    :return: the original input path and the path to the normalized image
     """
 
-    cos = math.cos(angle)
-    sin = math.sin(angle)
-    diff = points - origin
+    img_path, img_data, state_hash, scaled_dims, translation, angle = img_tuple
 
-    return np.column_stack([origin[0] + cos * diff[:, 0] - sin * diff[:, 1],
-                            origin[1] + sin * diff[:, 0] + cos * diff[:, 1]]).astype(int)
+    img = load_image(img_data["processed_path"])
 
+    # Compose the inverse mappings of resize, translate, rotate, and crop (in that order) into a single affine
+    # transform, so that the image is resampled only once instead of materializing an intermediate image per operation
+    scale_matrix = np.array([[img.width / scaled_dims[0], 0, 0], [0, img.height / scaled_dims[1], 0], [0, 0, 1]])
+    translation_matrix = np.array([[1, 0, -translation[0]], [0, 1, -translation[1]], [0, 0, 1]])
+    # The matrix maps output to input coordinates, so the rotation block is the inverse of the leveling rotation
+    cos, sin = math.cos(angle), math.sin(angle)
+    rotation_matrix = np.array([[cos, sin, 0], [-sin, cos, 0], [0, 0, 1]])
+    center_matrix = np.array([[1, 0, max_scaled_eye_center[0]], [0, 1, max_scaled_eye_center[1]], [0, 0, 1]])
+    uncenter_matrix = np.array([[1, 0, -max_scaled_eye_center[0]], [0, 1, -max_scaled_eye_center[1]], [0, 0, 1]])
+    crop_matrix = np.array([[1, 0, min_inner_boundaries[0]], [0, 1, min_inner_boundaries[1]], [0, 0, 1]])
+    matrix = scale_matrix @ translation_matrix @ center_matrix @ rotation_matrix @ uncenter_matrix @ crop_matrix
 
-def largest_inner_rectangle(corners: np.ndarray) -> np.ndarray:
-    """
-    Returns the largest non-rotated inner rectangle of the rectangle specified by [corners].
-
-    :param corners: the corners of the rectangle to find the inner rectangle in
-    :return: the largest non-rotated inner rectangle of the rectangle specified by [corners]
-    """
+    dims = (min_inner_boundaries[2] - min_inner_boundaries[0], min_inner_boundaries[3] - min_inner_boundaries[1])
+    img = img.transform(tuple(dims), Image.AFFINE, tuple(matrix[:2].flatten()), resample=Image.BICUBIC)
 
-    xs = np.sort(corners[:, 0])
-    ys = np.sort(corners[:, 1])
+    return img_path, normalized_cache.cache(img, img_data["hash"], state_hash)
 
-    return np.array([[xs[1], ys[1]], [xs[2], ys[2]]])
-
-
-def rectangle_overlap(rectangles: np.ndarray) -> np.ndarray:
-    """
-    Returns the largest rectangle that is within all [rectangles], assuming such a rectangle exists.
-
-    :param rectangles: the rectangle to find the overlap of
-    :return: the largest rectangle that is within all [rectangles], assuming such a rectangle exists
-    """
 
-    return np.array([np.max(rectangles[:, 0, 0]),
-                     np.max(rectangles[:, 0, 1]),
-                     np.min(rectangles[:, 1, 0]),
-                     np.min(rectangles[:, 1, 1])])
@@ -1,13 +1,17 @@
+import functools
+import mmap
 import sys
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Tuple
 
-import numpy as np
+import PIL
 from PIL import Image
-from tqdm import tqdm
+from tqdm.contrib.concurrent import thread_map
 
 import Hasher
+from Cache import PickleCache
 from Pipeline import PreprocessingStage, ImageInfo
+from UserException import UserException
 
 
 class ReadMetadataStage(PreprocessingStage):
@@ -15,26 +19,78 @@ class ReadMetadataStage(PreprocessingStage):
     Reads simple image metadata.
     """
 
+    metadata_cache: PickleCache
+
+    def __init__(self, cache_dir: str):
+        """
+        Constructs a new `ReadMetadataStage`.
+
+        :param cache_dir: the directory to store image metadata in
+        """
+
+        self.metadata_cache = PickleCache(cache_dir, "metadata", ".pickle", version="v2")
+
     def preprocess(self, imgs: Dict[Path, ImageInfo]) -> Dict[Path, ImageInfo]:
         """
         Reads image hash and dimensions as image metadata.
 
+        Images are read in a thread pool; hashing releases the GIL inside hashlib, so this overlaps the disk reads of
+        multiple files.
+
         :param imgs: a read-only mapping from original input paths to the preprocessed data obtained thus far
         :return: a mapping from original input path to the hash and dimensions of the image
         """
 
-        metadata = {}
+        return dict(thread_map(functools.partial(read_metadata, metadata_cache=self.metadata_cache),
+                               imgs.keys(),
+                               desc="Reading image metadata",
+                               file=sys.stdout))
+
+
+def read_metadata(img_path: Path, metadata_cache: PickleCache) -> Tuple[Path, ImageInfo]:
+    """
+    Reads the hash and dimensions of the image at [img_path].
+
+    Metadata is cached under the image's path, with the file's modification time and size as the state, so an image
+    that has not changed since the previous run costs only a `stat` call instead of a full read and hash.
+
+    Raises a [UserException] if the file is not an image of a supported type.
+
+    :param img_path: the path to the image to read metadata of
+    :param metadata_cache: the cache to store the read metadata in
+    :return: the original input path and the hash and dimensions of the image
+    """
+
+    stat = img_path.stat()
+    path_hash = Hasher.hash_string(str(img_path.resolve()))
+    state_hash = Hasher.hash_string(f"{stat.st_mtime_ns} {stat.st_size}")
+    if metadata_cache.has(path_hash, state_hash):
+        return img_path, metadata_cache.load(path_hash, state_hash)
 
-        for img_path in tqdm(imgs.keys(), desc="Reading image metadata", file=sys.stdout):
-            img_hash = Hasher.hash_file(img_path)
+    # An empty file cannot be memory-mapped, and is certainly not a supported image
+    if stat.st_size == 0:
+        raise UserException(f"Unsupported image type for input '{img_path}'.")
 
-            img = Image.open(img_path)
-            width, height = img.size
-            exif = img.getexif().get(0x0112)
-            if exif == 6 or exif == 8:
-                width, height = height, width  # Swap if EXIF tag indicates 90-degree rotation
-            img_dims = np.array([width, height])
+    # Memory-map the file so that both the hash and the image header are read from a single buffer, instead of
+    # reading the file from disk twice
+    with open(img_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)  # Hashing touches each page exactly once, so ask for read-ahead
+        img_hash = Hasher.hash_bytes(mm)
 
-            metadata[img_path] = {"hash": img_hash, "dims": img_dims}
+        # Unlike file objects, mmaps raise a ValueError when a format prober seeks past the end of the file, so a
+        # ValueError here also means the file is not a supported image
+        try:
+            img = Image.open(mm)
+        except (PIL.UnidentifiedImageError, ValueError):
+            raise UserException(f"Unsupported image type for input '{img_path}'.") from None
+        width, height = img.size
+        exif = img.getexif().get(0x0112)
+    if exif == 6 or exif == 8:
+        width, height = height, width  # Swap if EXIF tag indicates 90-degree rotation
 
-        return metadata
+    # A plain tuple is much cheaper to allocate and pickle than a two-element ndarray; consumers that need vector math
+    # stack the dimensions of all images into a single array anyway
+    img_data = {"hash": img_hash, "dims": (width, height)}
+    metadata_cache.cache(img_data, path_hash, state_hash)
+    return img_path, img_data
@@ -15,6 +15,9 @@ config = {
     "find_faces": {
         # Directory to store images in that caused an error.
         "error_dir": "output/error/",
+        # The width in pixels to downscale images to before searching for faces, to speed up detection. Images that are
+        # already narrower than this are not scaled. Increase this value if faces are not detected in your images.
+        "detection_width": 640,
         # Determines which face should be used for normalization if an image contains multiple faces.
         #
         # Add an entry for each image that contains multiple faces. The entry maps the filename of the image (without
@@ -65,6 +68,9 @@ config = {
         "fps": 24,
         # The codec to use for the output video. x264 is a very widely supported codec.
         "codec": "libx264",
+        # The encoder preset, trading encoding speed for file size. For x264, valid values range from "ultrafast" to
+        # "veryslow". Leave empty to use the codec's default preset.
+        "preset": "",
         # The "compression level" of the output video. A lower value means higher quality. Recommended between 18 and
         # 28.
         "crf": 23,